@@ -1,19 +1,26 @@
+import asyncio
 import datetime
+import functools
 import hashlib
 import os
 import logging
+import re
+import sys
 from pathlib import Path
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union, Tuple, Iterable, Mapping
 from urllib.parse import urlparse
 
 import asynch
 from asynch.connection import Connection
-from asynch.cursors import DictCursor
-from jinja2 import Environment, FileSystemLoader
+from asynch.cursors import Cursor
+from asynch.errors import ErrorCode, ServerException
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
 
-from clickhouse_migrate.utils import remove_suffix
+from clickhouse_migrate.utils import file_hash, split_statements
 
 
 logger = logging.getLogger(__name__)
@@ -39,6 +46,24 @@ def show_migration_error(fn):
     return wrapped
 
 
+_MIGRATION_FILE_RE = re.compile(r"^(\d+)_(.+?)\.(up|down)\.sql$")
+
+_SLOTS: Dict[str, bool] = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+@functools.lru_cache(maxsize=32)
+def _jinja_env(migration_path: str) -> Environment:
+    bytecode_cache = None
+    if os.environ.get("CHMIGRATE_JINJA_CACHE", "") == "1":
+        bytecode_cache = FileSystemBytecodeCache()
+    return Environment(
+        loader=FileSystemLoader(migration_path),
+        auto_reload=True,
+        cache_size=400,
+        bytecode_cache=bytecode_cache,
+    )
+
+
 class StrEnum(str, Enum):
     def __str__(self):
         return self.value
@@ -57,19 +82,45 @@ class Action(StrEnum):
     DOWN = "down"
 
 
-@dataclass
+_DIRTY_STATUSES = frozenset({Status.DIRTY_UP, Status.DIRTY_DOWN})
+
+
+@dataclass(**_SLOTS)
 class MigrationFiles:
     version: int
     name: str
-    up: Optional[str] = None
-    up_md5: Optional[str] = None
+    path: str = ""
     up_filename: Optional[str] = None
-    down: Optional[str] = None
-    down_md5: Optional[str] = None
     down_filename: Optional[str] = None
+    hash_algorithm: str = "md5"
+    _up_md5: Optional[str] = field(default=None, repr=False, compare=False)
+    _down_md5: Optional[str] = field(default=None, repr=False, compare=False)
+
+    def _md5(self, filename: Optional[str]) -> Optional[str]:
+        if filename is None:
+            return None
+        return file_hash(os.path.join(self.path, filename), self.hash_algorithm)
+
+    @property
+    def up_md5(self) -> Optional[str]:
+        if self._up_md5 is None:
+            self._up_md5 = self._md5(self.up_filename)
+        return self._up_md5
+
+    @property
+    def down_md5(self) -> Optional[str]:
+        if self._down_md5 is None:
+            self._down_md5 = self._md5(self.down_filename)
+        return self._down_md5
 
+    def _warm_digests(self):
+        if self._up_md5 is None:
+            self._up_md5 = self._md5(self.up_filename)
+        if self._down_md5 is None:
+            self._down_md5 = self._md5(self.down_filename)
 
-@dataclass
+
+@dataclass(frozen=True, **_SLOTS)
 class MigrationRecord:
     version: int
     name: str = ""
@@ -89,13 +140,21 @@ class ClickHouseMigrate:
         "ca_certs": "",
     }
     database: str = ""
-    _is_database_exists = False
+    # pooled connections are used through cursors that are never closed:
+    # asynch closes the connection together with its cursor
+    _pool: Optional[List[Connection]] = None
+    _pool_slots: Optional[asyncio.Semaphore] = None
+    pool_size: int = 5
+    hash_algorithm: str = "md5"
+    _schema_ready = False
     migrations_table: str = "schema_migrations"
     migration_path: str = "migrations"
 
-    environ: Dict[str, Any] = {}
+    environ: Mapping[str, Any] = {}
 
     MULTISTATE_SEPARATOR = ";"
+    MD5_PARALLEL_THRESHOLD = 16
+    LOG_COLUMNS = ("version", "name", "status", "up_md5", "down_md5", "created_at")
 
     def __init__(
         self,
@@ -109,12 +168,14 @@ class ClickHouseMigrate:
         password: str = "",
         migrations_path: Optional[str] = None,
         migrations_table: Optional[str] = None,
-        environ: Optional[Dict[str, Any]] = None,
+        environ: Optional[Mapping[str, Any]] = None,
         verbose: bool = False,
         secure: bool = False,
         ca_certs: str = "",
+        pool_size: Optional[int] = None,
+        hash_algorithm: Optional[str] = None,
     ):
-
+        self.connection_params = {**self.connection_params}
         if clickhouse_conn:
             self.database = clickhouse_conn.database
             self.connection_params.update(
@@ -155,65 +216,180 @@ class ClickHouseMigrate:
                 "ca_certs": ca_certs,
             }
         )
+        self._conn_kwargs = {"database": self.database, **self.connection_params}
+        self.pool_size = pool_size or self.pool_size
+        self.hash_algorithm = hash_algorithm or self.hash_algorithm
+        if not hashlib.new(self.hash_algorithm).digest_size:
+            raise ValueError(f"unsupported hash type {self.hash_algorithm}")
 
         self.migration_path = migrations_path or self.migration_path
         self.migrations_table = migrations_table or self.migrations_table
-        self.jinja_env = Environment(
-            loader=FileSystemLoader(self.migration_path),
+        self._migration_dir = Path(self.migration_path)
+        self._migration_dir.mkdir(parents=True, exist_ok=True)
+        self.jinja_env = _jinja_env(self.migration_path)
+        self._tpl_cache: Dict[str, Union[str, Template]] = {}
+        self.environ = environ if environ is not None else {}
+        # environ is read once, on the first templated render
+        self._environ_values: Optional[Dict[str, Any]] = None
+        self._render_cache: Dict[str, str] = {}
+        self._stmt_cache: Dict[str, List[str]] = {}
+        columns = ", ".join(self.LOG_COLUMNS)
+        self._log_insert_query = (
+            f"INSERT INTO {self.migrations_table} ({columns}) VALUES"
         )
-        self.environ = environ or {}
+        self._q_create_table = f"""
+            CREATE TABLE IF NOT EXISTS {self.migrations_table} (
+                version UInt32,
+                name String,
+                status String, 
+                up_md5 String, 
+                down_md5 String, 
+                created_at DateTime64(9) DEFAULT now64()
+            ) Engine=MergeTree ORDER BY (created_at)"""
+        select_meta = f"SELECT {columns} FROM `{self.migrations_table}`"
+        self._q_select_meta_desc = f"{select_meta} ORDER BY (created_at) DESC"
+        self._q_select_meta_asc = f"{select_meta} ORDER BY (created_at) ASC"
+        self._q_select_head = f"{self._q_select_meta_desc} LIMIT %(limit)s"
+        self._q_select_latest = (
+            f"SELECT version, status FROM `{self.migrations_table}` "
+            f"ORDER BY (created_at) DESC LIMIT 1"
+        )
+        self._pending_log: List[Tuple] = []
+        self._last_log_at: Optional[datetime.datetime] = None
+        self._file_migrations_cache: Optional[
+            Tuple[Tuple[Tuple[str, int, int], ...], List[MigrationFiles]]
+        ] = None
 
         logger.debug(f"init params: {self.connection_params}")
 
-    async def _check_database_exist(self):
-        if not self._is_database_exists:
-            conn = await asynch.connect(**self.connection_params)
-            async with conn.cursor() as cursor:
-                await cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{self.database}`")
-                self.is_database_exists = True
+    async def _connect(self) -> Connection:
+        conn = Connection(**self._conn_kwargs)
+        try:
+            await conn.connect()
+        except BaseException as e:
+            await conn.close()
+            if not (
+                isinstance(e, ServerException) and e.code == ErrorCode.UNKNOWN_DATABASE
+            ):
+                raise
+        else:
+            return conn
+        await self._create_database()
+        return await asynch.connect(**self._conn_kwargs)
 
-    async def _execute(self, query, args=None):
-        conn = await asynch.connect(database=self.database, **self.connection_params)
-        async with conn.cursor(cursor=DictCursor) as cursor:
-            res = await cursor.execute(query, args)
-            return res, cursor.fetchall()
+    async def _create_database(self):
+        logger.debug(f"Create database {self.database}")
+        conn = await asynch.connect(**self.connection_params)
+        try:
+            await conn.cursor().execute(
+                f"CREATE DATABASE IF NOT EXISTS `{self.database}`"
+            )
+        finally:
+            await conn.close()
+
+    async def _acquire(self) -> Connection:
+        if self._pool_slots is None:
+            self._pool = []
+            self._pool_slots = asyncio.Semaphore(self.pool_size)
+        await self._pool_slots.acquire()
+        if self._pool:
+            return self._pool.pop()
+        try:
+            return await self._connect()
+        except BaseException:
+            self._pool_slots.release()
+            raise
+
+    async def _release(self, conn: Connection, broken: bool = False):
+        try:
+            if broken:
+                await conn.close()
+            else:
+                self._pool.append(conn)
+        finally:
+            self._pool_slots.release()
+
+    @asynccontextmanager
+    async def _connection(self):
+        conn = await self._acquire()
+        broken = False
+        try:
+            yield conn
+        except ServerException:
+            raise
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            await self._release(conn, broken)
+
+    async def aclose(self):
+        while self._pool:
+            await self._pool.pop().close()
+
+    async def _execute_script(self, queries: List[str]):
+        async with self._connection() as conn:
+            cursor = conn.cursor()
+            for query in queries:
+                await cursor.execute(query)
+
+    async def _execute_no_result(self, query, args=None) -> int:
+        async with self._connection() as conn:
+            return await conn.cursor().execute(query, args)
+
+    async def _execute_fetch_all(self, query, args=None, cursor_cls=Cursor) -> List:
+        async with self._connection() as conn:
+            cursor = conn.cursor(cursor=cursor_cls)
+            await cursor.execute(query, args)
+            return cursor.fetchall()
+
+    async def _execute_fetch_one(self, query, args=None, cursor_cls=Cursor):
+        async with self._connection() as conn:
+            cursor = conn.cursor(cursor=cursor_cls)
+            await cursor.execute(query, args)
+            return cursor.fetchone()
 
     @show_migration_error
     async def make(self, name: str, force: bool = False):
-        file_migrations = self.file_migrations
+        file_migrations, latest = await asyncio.gather(
+            self._file_migrations_async(), self._latest_version_and_status()
+        )
         num = 1
         if file_migrations:
-            num = file_migrations[len(file_migrations)].version + 1
-        pos = self.position(await self.db_meta_migrations())
+            num = file_migrations[-1].version + 1
+        pos = self._position(latest)
         if not force and pos + 1 != num:
             raise MigrationError(f"Version: {pos + 1} not applied")
         for action in ("up", "down"):
             filename = f"{num:0>5d}_{name}.{action}.sql"
-            Path(os.path.join(self.migration_path, filename)).write_text("")
+            (self._migration_dir / filename).write_text("")
             logger.info(f"created migration {filename}")
 
     @show_migration_error
     async def show(self):
         logger.debug("Show migrations")
         metadata: Dict[int, MigrationRecord] = {}
-        db_meta_migrations = await self.db_meta_migrations()
+        file_migrations, db_meta_migrations = await asyncio.gather(
+            self._file_migrations_async(with_md5=True), self.db_meta_migrations()
+        )
         for m in db_meta_migrations:
             if m.version not in metadata:
                 metadata[m.version] = m
         current_version = self.position(db_meta_migrations)
+        if not logger.isEnabledFor(logging.INFO):
+            return
 
         def _cmp_md5(left, right):
-            return "valid" if left == right else "invalid"
+            return "valid" if (left or "") == (right or "") else "invalid"
 
-        logger.info(
-            "version | name                           | status     | up_md5   | down_md5 | created_at"
-        )
-        logger.info("-" * 104)
-        file_migrations = self.file_migrations
-        for version in sorted(file_migrations.keys()):
-            f = file_migrations[version]
-            d = metadata.get(version) or MigrationRecord(version=version)
-            status = d.status if current_version >= version else "-"
+        row = "%-7d | %-30s | %-10s | %-8s | %-8s | %-30s"
+        out = [
+            "version | name                           | status     | up_md5   | down_md5 | created_at",
+            "-" * 104,
+        ]
+        for f in file_migrations:
+            d = metadata.get(f.version) or MigrationRecord(version=f.version)
+            status = d.status if current_version >= f.version else "-"
             created_at = d.created_at or "-"
             if created_at != "-":
                 created_at = created_at.isoformat()
@@ -222,47 +398,68 @@ class ClickHouseMigrate:
                 valid_down = _cmp_md5(f.down_md5, d.down_md5)
             else:
                 valid_up = valid_down = "-"
-            logger.info(
-                f"{f.version:<7d} | {f.name:<30s} | {status:<10s} | {valid_up:<8s} | {valid_down:<8s} | {created_at:<30s}"
+            out.append(
+                row % (f.version, f.name, status, valid_up, valid_down, created_at)
             )
-        logger.info("-" * 104)
+        out.append("-" * 104)
+        logger.info("\n".join(out))
         if current_version > 0:
             logger.info(
-                f"Current apply position version: "
-                f"{file_migrations[current_version].version} - "
-                f"{file_migrations[current_version].name}: "
-                f"{db_meta_migrations[0].status}"
+                "Current apply position version: %s - %s: %s",
+                file_migrations[current_version - 1].version,
+                file_migrations[current_version - 1].name,
+                db_meta_migrations[0].status,
             )
 
     @show_migration_error
     async def show_playbook(self):
         def _cmp_md5(left, right):
-            return "valid" if left == right else "invalid"
+            return "valid" if (left or "") == (right or "") else "invalid"
 
         logger.debug("Show playbook")
-        file_migrations = self.file_migrations
-        db_meta_migrations = await self.db_meta_migrations(reverse=False)
-        logger.info(
-            "num | version | name                           | status     | up_md5   | down_md5 | created_at"
+        file_migrations, db_meta_migrations = await asyncio.gather(
+            self._file_migrations_async(with_md5=True),
+            self.db_meta_migrations(reverse=False),
         )
-        logger.info("-" * 110)
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        row = "%-3d | %-7d | %-30s | %-10s | %-8s | %-8s | %-30s"
+        out = [
+            "num | version | name                           | status     | up_md5   | down_md5 | created_at",
+            "-" * 110,
+        ]
         for i, m in enumerate(db_meta_migrations):
-            f = file_migrations.get(m.version)
+            f = (
+                file_migrations[m.version - 1]
+                if 0 < m.version <= len(file_migrations)
+                else None
+            )
             if f:
                 valid_up = _cmp_md5(f.up_md5, m.up_md5)
                 valid_down = _cmp_md5(f.down_md5, m.down_md5)
             else:
                 valid_up = valid_down = "lost"
-            logger.info(
-                f"{i+1:<3d} | {m.version:<7d} | {m.name:<30s} | {m.status:<10s} | {valid_up:<8s} | {valid_down:<8s} | {m.created_at.isoformat():<30s}"
+            out.append(
+                row
+                % (
+                    i + 1,
+                    m.version,
+                    m.name,
+                    m.status,
+                    valid_up,
+                    valid_down,
+                    m.created_at.isoformat(),
+                )
             )
-        logger.info("-" * 110)
+        out.append("-" * 110)
+        logger.info("\n".join(out))
 
     async def show_sql(self, step: int, action: Action = Action.UP):
         logger.info("Show SQL")
-        file_migrations = self.file_migrations
+        file_migrations = await self._file_migrations_async()
         if len(file_migrations) < step:
             logger.info("migration not found")
+            return
         scripts = (
             self._render(file_migrations[step - 1].up_filename)
             if action == Action.UP
@@ -272,10 +469,10 @@ class ClickHouseMigrate:
 
     @show_migration_error
     async def force(self, reset=False):
-        meta = await self.db_meta_migrations()
+        meta = await self._db_head_migration(limit=2)
         if not meta:
             raise MigrationError("migration not found")
-        if meta[0].status not in [Status.DIRTY_UP, Status.DIRTY_DOWN]:
+        if meta[0].status not in _DIRTY_STATUSES:
             raise MigrationError("current migration not dirty")
         if not reset:
             logger.info("Force apply last migration")
@@ -308,174 +505,340 @@ class ClickHouseMigrate:
                 )
 
     @show_migration_error
-    async def up(self, *, step: Optional[int] = None):
-        file_migrations = self.file_migrations
-        step = step or len(file_migrations)
-        migrations = await self.db_meta_migrations()
-        self._check_current_migration(migrations)
-        pos = self.position(migrations)
-        play_migration = sorted(
-            [k for k in file_migrations.keys() if pos < k <= pos + step]
+    async def up(self, *, step: Optional[int] = None, parallel: int = 1):
+        file_migrations, latest = await asyncio.gather(
+            self._file_migrations_async(), self._latest_version_and_status()
         )
-        for version in play_migration:
-            f = file_migrations[version]
-            await self._apply_migrate(f, Action.UP)
+        step = step or len(file_migrations)
+        self._check_current_migration(latest)
+        pos = self._position(latest)
+        files = file_migrations[pos : pos + step]
+        await self._hash_files_async(files)
+        try:
+            if parallel > 1:
+                await self._apply_migrate_parallel(files, Action.UP, parallel)
+                return
+            for f in files:
+                await self._apply_migrate(f, Action.UP)
+        finally:
+            await self._flush_log()
 
     @show_migration_error
-    async def down(self, *, step: Optional[int] = None):
-        file_migrations = self.file_migrations
-        step = step or len(file_migrations)
-        migrations = await self.db_meta_migrations()
-        self._check_current_migration(migrations)
-        pos = self.position(migrations)
-        play_migration = reversed(
-            sorted([k for k in file_migrations.keys() if pos - step < k <= pos])
+    async def down(self, *, step: Optional[int] = None, parallel: int = 1):
+        file_migrations, latest = await asyncio.gather(
+            self._file_migrations_async(), self._latest_version_and_status()
         )
-        for version in play_migration:
-            f = file_migrations[version]
-            await self._apply_migrate(f, Action.DOWN)
+        step = step or len(file_migrations)
+        self._check_current_migration(latest)
+        pos = self._position(latest)
+        files = file_migrations[max(0, pos - step) : pos][::-1]
+        await self._hash_files_async(files)
+        try:
+            if parallel > 1:
+                await self._apply_migrate_parallel(files, Action.DOWN, parallel)
+                return
+            for f in files:
+                await self._apply_migrate(f, Action.DOWN)
+        finally:
+            await self._flush_log()
 
     @classmethod
-    def _check_current_migration(cls, migrations: List[MigrationRecord]):
-        if len(migrations) > 0 and migrations[0].status in [
-            Status.DIRTY_UP,
-            Status.DIRTY_DOWN,
-        ]:
-            raise MigrationError(f"Current migration {migrations[-1].status}")
+    def _check_current_migration(cls, latest: Optional[Tuple[int, str]]):
+        if latest is not None and latest[1] in _DIRTY_STATUSES:
+            raise MigrationError(f"Current migration {latest[1]}")
 
     async def _apply_migrate(self, meta: MigrationFiles, action: Action):
         logger.info(f"Start migrate {action.name} {meta.name}")
-        await self._log_action(
-            version=meta.version,
-            name=meta.name,
-            status=Status.DIRTY_UP if action == Action.UP else Status.DIRTY_DOWN,
-            up_md5=meta.up_md5,
-            down_md5=meta.down_md5,
+        self._pending_log.append(
+            self._meta_log_row(
+                meta, Status.DIRTY_UP if action == Action.UP else Status.DIRTY_DOWN
+            )
         )
-        scripts = (
-            self._render(meta.up_filename)
-            if action == Action.UP
-            else self._render(meta.down_filename)
+        await self._flush_log()
+        scripts = self._render_statements(
+            meta.up_filename if action == Action.UP else meta.down_filename
         )
-        scripts = [
-            c
-            for c in [s.strip() for s in scripts.split(self.MULTISTATE_SEPARATOR)]
-            if c
-        ]
-        for query in scripts:
-            await self._execute(query)
-        await self._log_action(
+        await self._execute_script(scripts)
+        self._pending_log.append(
+            self._meta_log_row(meta, Status.UP if action == Action.UP else Status.DOWN)
+        )
+        logger.info(f"Start migrate {action.name} {meta.name} - Complete")
+
+    async def _apply_migrate_parallel(
+        self, files: List[MigrationFiles], action: Action, parallel: int
+    ):
+        dirty = Status.DIRTY_UP if action == Action.UP else Status.DIRTY_DOWN
+        done = Status.UP if action == Action.UP else Status.DOWN
+        undone = Status.DOWN if action == Action.UP else Status.UP
+        semaphore = asyncio.Semaphore(parallel)
+        stopped = asyncio.Event()
+
+        async def _run(meta: MigrationFiles) -> bool:
+            async with semaphore:
+                if stopped.is_set():
+                    return False
+                logger.info(f"Start migrate {action.name} {meta.name}")
+                try:
+                    await self._log_actions_bulk([self._meta_log_row(meta, dirty)])
+                    await self._execute_script(
+                        self._render_statements(
+                            meta.up_filename
+                            if action == Action.UP
+                            else meta.down_filename
+                        )
+                    )
+                except BaseException:
+                    stopped.set()
+                    raise
+                logger.info(f"Start migrate {action.name} {meta.name} - Complete")
+                return True
+
+        results = await asyncio.gather(
+            *(_run(meta) for meta in files), return_exceptions=True
+        )
+        clean = 0
+        while clean < len(files) and results[clean] is True:
+            self._pending_log.append(self._meta_log_row(files[clean], done))
+            clean += 1
+        failed: Optional[Tuple[MigrationFiles, BaseException]] = None
+        for meta, result in zip(files[clean:], results[clean:]):
+            if isinstance(result, BaseException):
+                logger.error(f"Migrate {action.name} {meta.name} failed: {result}")
+                failed = failed or (meta, result)
+            elif result:
+                logger.warning(
+                    f"Migrate {action.name} {meta.name} applied after a failed "
+                    f"migration, it is not recorded and has to be checked manually"
+                )
+        if failed is not None:
+            meta, error = failed
+            if clean == 0:
+                self._pending_log.append(self._meta_log_row(files[0], undone))
+            self._pending_log.append(self._meta_log_row(meta, dirty))
+            raise error
+
+    def _render(self, filename: str) -> str:
+        template = self._tpl_cache.get(filename)
+        if template is None:
+            src = (self._migration_dir / filename).read_text()
+            if not any(marker in src for marker in ("{{", "{%", "{#")):
+                template = src
+            else:
+                template = self.jinja_env.get_template(filename)
+            self._tpl_cache[filename] = template
+        if isinstance(template, str):
+            return template
+        rendered = self._render_cache.get(filename)
+        if rendered is None:
+            if self._environ_values is None:
+                self._environ_values = dict(self.environ)
+            rendered = self._render_cache[filename] = template.render(
+                **self._environ_values
+            )
+        return rendered
+
+    def _render_statements(self, filename: str) -> List[str]:
+        sql = self._render(filename)
+        statements = self._stmt_cache.get(sql)
+        if statements is None:
+            statements = split_statements(sql, self.MULTISTATE_SEPARATOR)
+            self._stmt_cache[sql] = statements
+        return statements
+
+    def _log_row(self, *, version, name, status, up_md5, down_md5) -> Tuple:
+        created_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        if self._last_log_at is not None and created_at <= self._last_log_at:
+            created_at = self._last_log_at + datetime.timedelta(microseconds=1)
+        self._last_log_at = created_at
+        return version, name, status, up_md5 or "", down_md5 or "", created_at
+
+    def _meta_log_row(self, meta: MigrationFiles, status: Status) -> Tuple:
+        return self._log_row(
             version=meta.version,
             name=meta.name,
-            status=Status.UP if action == Action.UP else Status.DOWN,
+            status=status,
             up_md5=meta.up_md5,
             down_md5=meta.down_md5,
         )
-        logger.info(f"Start migrate {action.name} {meta.name} - Complete")
-
-    def _render(self, filename: str) -> str:
-        template = self.jinja_env.get_template(filename)
-        return template.render(**self.environ)
 
     async def _log_action(self, *, version, name, status, up_md5, down_md5):
-        await self._execute(
-            f"""INSERT INTO {self.migrations_table}
-            (version, name, status, up_md5, down_md5, created_at) 
-            VALUES""",
+        await self._log_actions_bulk(
             [
-                {
-                    "version": version,
-                    "name": name,
-                    "status": status,
-                    "up_md5": up_md5,
-                    "down_md5": down_md5,
-                    "created_at": datetime.datetime.utcnow(),
-                }
-            ],
+                self._log_row(
+                    version=version,
+                    name=name,
+                    status=status,
+                    up_md5=up_md5,
+                    down_md5=down_md5,
+                )
+            ]
         )
 
-    async def _check_migration_table(self):
-        logger.debug("Check migration table")
-        _, res = await self._execute(
-            f"SHOW TABLES FROM `{self.database}` LIKE '{self.migrations_table}'"
-        )
-        table_exist = len(res) > 0
-        logger.debug("Migration table %s", "OK" if table_exist else "NOT FOUND")
-        return table_exist
+    async def _log_actions_bulk(self, rows: List[Tuple]):
+        if not rows:
+            return
+        async with self._connection() as conn:
+            await conn.cursor().executemany(self._log_insert_query, rows)
+
+    async def _flush_log(self):
+        rows, self._pending_log = self._pending_log, []
+        await self._log_actions_bulk(rows)
 
     async def _create_migration_table(self):
         logger.debug("Create migration table...")
-        query = f"""
-            CREATE TABLE IF NOT EXISTS {self.migrations_table} (
-                version UInt32,
-                name String,
-                status String, 
-                up_md5 String, 
-                down_md5 String, 
-                created_at DateTime64(9) DEFAULT now64()
-            ) Engine=MergeTree ORDER BY (created_at)"""
-        await self._execute(query)
+        await self._execute_no_result(self._q_create_table)
         logger.debug("Create migration table...CREATED")
 
-    async def db_meta_migrations(self, reverse=True) -> List[MigrationRecord]:
-        await self._check_database_exist()
-        if not await self._check_migration_table():
+    async def _prepare_schema(self):
+        if not self._schema_ready:
             await self._create_migration_table()
-        _, res = await self._execute(
-            f"""SELECT version, name, status, up_md5, down_md5, created_at 
-                FROM `{self.migrations_table}` ORDER BY (created_at) {'DESC' if reverse else 'ASC'}"""
+            self._schema_ready = True
+
+    async def db_meta_migrations(self, reverse=True) -> List[MigrationRecord]:
+        await self._prepare_schema()
+        res = await self._execute_fetch_all(
+            self._q_select_meta_desc if reverse else self._q_select_meta_asc
+        )
+        return [self._record(row) for row in res]
+
+    async def _db_head_migration(self, limit: int = 2) -> List[MigrationRecord]:
+        await self._prepare_schema()
+        res = await self._execute_fetch_all(self._q_select_head, {"limit": int(limit)})
+        return [self._record(row) for row in res]
+
+    async def _latest_version_and_status(self) -> Optional[Tuple[int, str]]:
+        await self._prepare_schema()
+        return await self._execute_fetch_one(self._q_select_latest)
+
+    @classmethod
+    def _record(cls, row: Tuple) -> MigrationRecord:
+        version, name, status, up_md5, down_md5, created_at = row
+        return MigrationRecord(
+            version=version,
+            name=name,
+            status=status,
+            created_at=created_at,
+            up_md5=up_md5,
+            down_md5=down_md5,
         )
-        return [MigrationRecord(**d) for d in res]
 
     @classmethod
     def position(cls, db_meta_migrations: List[MigrationRecord]) -> int:
-        for m in db_meta_migrations:
-            if m.status == Status.DOWN:
-                return m.version - 1
-            else:
-                return m.version
-        return 0
+        if not db_meta_migrations:
+            return 0
+        return cls._position(
+            (db_meta_migrations[0].version, db_meta_migrations[0].status)
+        )
 
-    @property
-    def file_migrations(self) -> Dict[int, MigrationFiles]:
-        if not os.path.exists(self.migration_path):
-            os.makedirs(self.migration_path)
+    @classmethod
+    def _position(cls, latest: Optional[Tuple[int, str]]) -> int:
+        if latest is None:
+            return 0
+        version, status = latest
+        return version - 1 if status == Status.DOWN else version
 
-        data: Dict[int, MigrationFiles] = {}
-        for f in os.scandir(f"{self.migration_path}"):
+    @classmethod
+    def _hash_files(cls, files: Iterable[MigrationFiles]):
+        files = list(files)
+        if len(files) < cls.MD5_PARALLEL_THRESHOLD:
+            for f in files:
+                f._warm_digests()
+            return
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as pool:
+            list(pool.map(MigrationFiles._warm_digests, files))
+
+    async def _hash_files_async(self, files: List[MigrationFiles]):
+        if files:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._hash_files, files)
+
+    def file_migrations(self) -> List[MigrationFiles]:
+        return self._scan_migrations_sync()
+
+    async def _file_migrations_async(self, with_md5=False) -> List[MigrationFiles]:
+        def _scan():
+            files = self._scan_migrations_sync()
+            if with_md5:
+                self._hash_files(files)
+            return files
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, _scan)
+
+    def _scan_migrations_sync(self) -> List[MigrationFiles]:
+        ups: Dict[int, str] = {}
+        downs: Dict[int, str] = {}
+        signature = []
+        for f in os.scandir(self.migration_path):
             filename = f.name
-            if not filename.endswith(".up.sql"):
+            match = _MIGRATION_FILE_RE.match(filename)
+            if match is None:
                 continue
-            version = int(filename.split("_", 1)[0])
+            target = ups if match.group(3) == Action.UP else downs
+            version = int(match.group(1))
+            if version in target:
+                duplicates = ", ".join(sorted((target[version], filename)))
+                raise MigrationError(
+                    f"Version: {version} - duplicate migration files {duplicates}"
+                )
+            target[version] = filename
+            st = f.stat()
+            signature.append((filename, st.st_mtime_ns, st.st_size))
+        signature = tuple(sorted(signature))
+
+        if (
+            self._file_migrations_cache is not None
+            and self._file_migrations_cache[0] == signature
+        ):
+            return self._file_migrations_cache[1]
+
+        previous: Dict[int, MigrationFiles] = {}
+        old_stats: Dict[str, Tuple[int, int]] = {}
+        if self._file_migrations_cache is not None:
+            old_signature, old_files = self._file_migrations_cache
+            previous = {f.version: f for f in old_files}
+            old_stats = {name: (mtime, size) for name, mtime, size in old_signature}
+        stats = {name: (mtime, size) for name, mtime, size in signature}
+
+        def _unchanged(old_filename: Optional[str], filename: str) -> bool:
+            return (
+                old_filename == filename and old_stats.get(filename) == stats[filename]
+            )
 
+        data: Dict[int, MigrationFiles] = {}
+        for version, filename in ups.items():
             data[version] = MigrationFiles(
                 version=version,
-                name=remove_suffix(filename, ".up.sql"),
-                up=Path(f"{self.migration_path}/{filename}").read_text(),
+                name=filename[: -len(".up.sql")],
+                path=self.migration_path,
                 up_filename=filename,
+                hash_algorithm=self.hash_algorithm,
             )
-            data[version].up_md5 = hashlib.md5(data[version].up.encode()).hexdigest()
+            old = previous.get(version)
+            if old is not None and _unchanged(old.up_filename, filename):
+                data[version]._up_md5 = old._up_md5
 
-        for f in os.scandir(f"{self.migration_path}"):
-            filename = f.name
-            if not filename.endswith(".down.sql"):
-                continue
-            version = int(filename.split("_", 1)[0])
+        for version, filename in downs.items():
             if version not in data:
                 raise MigrationError(
                     f"Version: {version} - not found up migration file"
                 )
-            data[version].down = Path(f"{self.migration_path}/{filename}").read_text()
-            data[version].down_md5 = hashlib.md5(
-                data[version].down.encode()
-            ).hexdigest()
             data[version].down_filename = filename
+            old = previous.get(version)
+            if old is not None and _unchanged(old.down_filename, filename):
+                data[version]._down_md5 = old._down_md5
 
-        keys = list(data.keys())
-        keys = sorted(keys)
-        for i, version in enumerate(keys):
-            if i != version - 1:
+        if data and (len(data) != max(data) or min(data) != 1):
+            unexpected = sorted(version for version in data if version < 1)
+            if unexpected:
                 raise MigrationError(
-                    f"Version: {version} in position {i} - broken file sequence"
+                    f"Versions: {', '.join(map(str, unexpected))} - unexpected, "
+                    f"versions start at 1"
                 )
-        return data
+            missing = sorted(set(range(1, max(data) + 1)) - data.keys())
+            raise MigrationError(
+                f"Versions: {', '.join(map(str, missing))} - broken file sequence"
+            )
+        files = [data[version] for version in sorted(data)]
+        self._file_migrations_cache = (signature, files)
+        return files
@@ -1,22 +1,22 @@
 import argparse
 import asyncio
+import functools
 import os
+import stat
 import sys
 import logging
-
-from dotenv import dotenv_values
-
-from clickhouse_migrate.migrate import ClickHouseMigrate, Action
+import types
 
 
 APP_NAME = "chmigrate"
 
 logger = logging.getLogger(APP_NAME)
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(message)s")
-handler = logging.StreamHandler(sys.stdout)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+if not logger.handlers:
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter("%(message)s")
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
 
 
 def check_positive_int(value):
@@ -26,6 +26,10 @@ def check_positive_int(value):
     return val
 
 
+def str_to_bool(value):
+    return value.lower() == "true"
+
+
 def _add_known_args(parser):
     parser.add_argument(
         "--env", type=str, default=".env", help="environment variables (default: .env)"
@@ -39,6 +43,24 @@ def _add_known_args(parser):
 
 
 ENV_PREFIX = ""
+_ENV_SNAPSHOT = None
+
+
+@functools.lru_cache(maxsize=8)
+def _load_dotenv_cached(path, mtime_ns, size):
+    from dotenv import dotenv_values
+
+    return dotenv_values(path)
+
+
+def _load_dotenv(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    if not stat.S_ISREG(st.st_mode):
+        return {}
+    return _load_dotenv_cached(path, st.st_mtime_ns, st.st_size)
 
 
 def _load_environment_from_file():
@@ -46,88 +68,21 @@ def _load_environment_from_file():
     _add_known_args(parser)
     args, extra = parser.parse_known_args()
 
-    global ENV_PREFIX
+    global ENV_PREFIX, _ENV_SNAPSHOT
     ENV_PREFIX = args.prefix
 
-    env_file = dotenv_values(args.env)
-    os.environ.update(env_file)
+    env_file = _load_dotenv(args.env)
+    if env_file:
+        os.environ.update(env_file)
+    _ENV_SNAPSHOT = dict(os.environ)
 
 
 def get_env(name, default=""):
-    return os.environ.get(ENV_PREFIX + name, default=default)
+    env = os.environ if _ENV_SNAPSHOT is None else _ENV_SNAPSHOT
+    return env.get(ENV_PREFIX + name, default)
 
 
-async def _run():
-    _load_environment_from_file()
-
-    parser = argparse.ArgumentParser(APP_NAME)
-    _add_known_args(parser)
-
-    parser.add_argument(
-        "--dsn",
-        type=str,
-        default=get_env("CLICKHOUSE_DSN", ""),
-        help="clickhouse dsn. Env: CLICKHOUSE_DSN (default: none",
-    )
-    parser.add_argument(
-        "--host",
-        type=str,
-        default=get_env("CLICKHOUSE_HOST", "localhost"),
-        help="clickhouse host. Env: CLICKHOUSE_HOST (default: localhost)",
-    )
-    parser.add_argument(
-        "--port",
-        type=int,
-        default=get_env("CLICKHOUSE_PORT", 9000),
-        help="clickhouse port. Env: CLICKHOUSE_PORT (default: 9000)",
-    )
-    parser.add_argument(
-        "--username",
-        type=str,
-        default=get_env("CLICKHOUSE_USERNAME", "")
-        or get_env("CLICKHOUSE_USER", "default"),
-        help='clickhouse user. Env: CLICKHOUSE_USERNAME (default: "default")',
-    )
-    parser.add_argument(
-        "--password",
-        type=str,
-        default=get_env("CLICKHOUSE_PASSWORD", ""),
-        help='clickhouse password. Env: CLICKHOUSE_USER (default: "")',
-    )
-    parser.add_argument(
-        "--database",
-        type=str,
-        default=get_env("CLICKHOUSE_DATABASE", ""),
-        help='clickhouse database. Env: CLICKHOUSE_DATABASE (default: "")',
-    )
-    parser.add_argument(
-        "--secure",
-        type=str,
-        default=get_env("CLICKHOUSE_SECURE", "false"),
-        help='clickhouse secure connection. Env: CLICKHOUSE_SECURE (default: "false")',
-    )
-    parser.add_argument(
-        "--ca-certs",
-        type=str,
-        default=get_env("CLICKHOUSE_CA_CERTS", ""),
-        help='clickhouse CA certificate connection. Env: CLICKHOUSE_CA_CERTS (default: "")',
-    )
-    parser.add_argument(
-        "--migration-path",
-        type=str,
-        default=get_env("MIGRATION_PATH", "migrations"),
-        help="migration path. Env: MIGRATION_PATH (default: migrations)",
-    )
-    parser.add_argument(
-        "--migration-table",
-        type=str,
-        default=get_env("MIGRATIONS_TABLE", "schema_migrations"),
-        help="migration table. Env: MIGRATIONS_TABLE (default: schema_migrations)",
-    )
-    parser.add_argument("--verbose", action="store_true", help="Verbose output")
-
-    subparsers = parser.add_subparsers(dest="subparser_name")
-
+def _add_make_parser(subparsers):
     parser_make = subparsers.add_parser("make", help="make new migration")
     parser_make.add_argument(
         "name", type=str, nargs="?", default="new", help="migration name (default: new)"
@@ -136,38 +91,228 @@ async def _run():
         "--force", action="store_true", help="force make migration files"
     )
 
+
+def _add_show_parser(subparsers):
     subparsers.add_parser("show", help="show migrations")
 
+
+def _add_show_sql_parser(subparsers):
     show_sql = subparsers.add_parser(
         "show_sql", help="show DDL migrations after parse template engine"
     )
     show_sql.add_argument("step", type=check_positive_int, help="migration step")
     show_sql.add_argument("direction", type=str, help="up|down")
 
+
+def _add_playbook_parser(subparsers):
     subparsers.add_parser("playbook", help="show playbook")
 
+
+def _add_up_parser(subparsers):
     parser_up = subparsers.add_parser("up", help="migrate up")
     parser_up.add_argument(
         "step", type=check_positive_int, nargs="?", help="migration step"
     )
+    parser_up.add_argument(
+        "--parallel",
+        type=check_positive_int,
+        default=1,
+        help="migrations applied concurrently (default: 1)",
+    )
 
+
+def _add_down_parser(subparsers):
     parser_down = subparsers.add_parser("down", help="migrate down")
     parser_down.add_argument(
         "step", type=check_positive_int, nargs="?", help="migration step"
     )
+    parser_down.add_argument(
+        "--parallel",
+        type=check_positive_int,
+        default=1,
+        help="migrations applied concurrently (default: 1)",
+    )
+
 
+def _add_force_parser(subparsers):
     subparsers.add_parser("force", help="force last dirty migration mark as success")
 
+
+def _add_reset_parser(subparsers):
     subparsers.add_parser("reset", help="reset last dirty migration")
 
+
+SUBCOMMANDS = {
+    "make": _add_make_parser,
+    "show": _add_show_parser,
+    "show_sql": _add_show_sql_parser,
+    "playbook": _add_playbook_parser,
+    "up": _add_up_parser,
+    "down": _add_down_parser,
+    "force": _add_force_parser,
+    "reset": _add_reset_parser,
+}
+
+_FLAG_OPTIONS = {"-h", "--help", "--verbose"}
+
+
+def _subcommand(argv):
+    skip_value = False
+    for token in argv:
+        if skip_value:
+            skip_value = False
+        elif token.startswith("-"):
+            skip_value = "=" not in token and token not in _FLAG_OPTIONS
+        else:
+            return token
+    return None
+
+
+def _show_sql(m, args):
+    from clickhouse_migrate.migrate import Action
+
+    return m.show_sql(
+        args.step, Action.DOWN if args.direction.lower() == "down" else Action.UP
+    )
+
+
+DISPATCH = {
+    "show": lambda m, args: m.show(),
+    "show_sql": _show_sql,
+    "make": lambda m, args: m.make(args.name, args.force),
+    "playbook": lambda m, args: m.show_playbook(),
+    "up": lambda m, args: m.up(step=args.step, parallel=args.parallel),
+    "down": lambda m, args: m.down(step=args.step, parallel=args.parallel),
+    "force": lambda m, args: m.force(),
+    "reset": lambda m, args: m.force(reset=True),
+}
+
+
+# flag, type, environment variables, default, help
+OPTIONS = (
+    (
+        "--dsn",
+        str,
+        ("CLICKHOUSE_DSN",),
+        "",
+        "clickhouse dsn. Env: CLICKHOUSE_DSN (default: none",
+    ),
+    (
+        "--host",
+        str,
+        ("CLICKHOUSE_HOST",),
+        "localhost",
+        "clickhouse host. Env: CLICKHOUSE_HOST (default: localhost)",
+    ),
+    (
+        "--port",
+        int,
+        ("CLICKHOUSE_PORT",),
+        9000,
+        "clickhouse port. Env: CLICKHOUSE_PORT (default: 9000)",
+    ),
+    (
+        "--username",
+        str,
+        ("CLICKHOUSE_USERNAME", "CLICKHOUSE_USER"),
+        "default",
+        'clickhouse user. Env: CLICKHOUSE_USERNAME (default: "default")',
+    ),
+    (
+        "--password",
+        str,
+        ("CLICKHOUSE_PASSWORD",),
+        "",
+        'clickhouse password. Env: CLICKHOUSE_USER (default: "")',
+    ),
+    (
+        "--database",
+        str,
+        ("CLICKHOUSE_DATABASE",),
+        "",
+        'clickhouse database. Env: CLICKHOUSE_DATABASE (default: "")',
+    ),
+    (
+        "--secure",
+        str_to_bool,
+        ("CLICKHOUSE_SECURE",),
+        "false",
+        'clickhouse secure connection. Env: CLICKHOUSE_SECURE (default: "false")',
+    ),
+    (
+        "--ca-certs",
+        str,
+        ("CLICKHOUSE_CA_CERTS",),
+        "",
+        'clickhouse CA certificate connection. Env: CLICKHOUSE_CA_CERTS (default: "")',
+    ),
+    (
+        "--migration-path",
+        str,
+        ("MIGRATION_PATH",),
+        "migrations",
+        "migration path. Env: MIGRATION_PATH (default: migrations)",
+    ),
+    (
+        "--migration-table",
+        str,
+        ("MIGRATIONS_TABLE",),
+        "schema_migrations",
+        "migration table. Env: MIGRATIONS_TABLE (default: schema_migrations)",
+    ),
+    (
+        "--hash-algorithm",
+        str,
+        ("MIGRATION_HASH_ALGORITHM",),
+        "md5",
+        "migration files digest, e.g. sha256. Env: MIGRATION_HASH_ALGORITHM (default: md5)",
+    ),
+)
+
+
+def _env_default(env_names, default):
+    for name in env_names[:-1]:
+        value = get_env(name)
+        if value:
+            return value
+    return get_env(env_names[-1], default)
+
+
+def _build_parser(argv):
+    parser = argparse.ArgumentParser(APP_NAME)
+    _add_known_args(parser)
+
+    for flag, arg_type, env_names, default, help_ in OPTIONS:
+        parser.add_argument(
+            flag, type=arg_type, default=_env_default(env_names, default), help=help_
+        )
+    parser.add_argument("--verbose", action="store_true", help="Verbose output")
+
+    subparsers = parser.add_subparsers(dest="subparser_name")
+    command = _subcommand(argv)
+    if command in SUBCOMMANDS:
+        SUBCOMMANDS[command](subparsers)
+    else:
+        for add_parser in SUBCOMMANDS.values():
+            add_parser(subparsers)
+    return parser
+
+
+async def _run():
+    _load_environment_from_file()
+
+    parser = _build_parser(sys.argv[1:])
     args = parser.parse_args()
+    from clickhouse_migrate.migrate import ClickHouseMigrate
 
+    level = logging.DEBUG if args.verbose else logging.INFO
     if args.verbose:
         logging.basicConfig(
-            format="%(asctime)s[%(levelname)s]: %(message)s", level=logging.DEBUG
+            format="%(asctime)s[%(levelname)s]: %(message)s", level=level
         )
     else:
-        logging.basicConfig(format="%(message)s", level=logging.INFO)
+        logging.basicConfig(format="%(message)s", level=level)
+    logging.getLogger().setLevel(level)
 
     m = ClickHouseMigrate(
         clickhouse_dsn=args.dsn,
@@ -178,35 +323,42 @@ async def _run():
         database=args.database,
         migrations_path=args.migration_path,
         migrations_table=args.migration_table,
-        environ={**os.environ},
-        secure=args.secure.lower() == "true",
+        environ=types.MappingProxyType(os.environ),
+        secure=args.secure,
         ca_certs=args.ca_certs,
+        hash_algorithm=args.hash_algorithm,
     )
 
-    if args.subparser_name == "show":
-        await m.show()
-    elif args.subparser_name == "show_sql":
-        await m.show_sql(
-            args.step, Action.DOWN if args.direction.lower() == "down" else Action.UP
-        )
-    elif args.subparser_name == "make":
-        await m.make(args.name, args.force)
-    elif args.subparser_name == "playbook":
-        await m.show_playbook()
-    elif args.subparser_name == "up":
-        await m.up(step=args.step)
-    elif args.subparser_name == "down":
-        await m.down(step=args.step)
-    elif args.subparser_name == "force":
-        await m.force()
-    elif args.subparser_name == "reset":
-        await m.force(reset=True)
-    else:
-        parser.print_help()
+    handler = DISPATCH.get(args.subparser_name)
+    try:
+        if handler:
+            await handler(m, args)
+        else:
+            parser.print_help()
+    finally:
+        await m.aclose()
+
+
+def _uvloop():
+    if sys.platform == "win32":
+        return None
+    try:
+        import uvloop
+    except ImportError:
+        return None
+    return uvloop
 
 
 def run():
-    asyncio.run(_run())
+    uvloop = _uvloop()
+    if uvloop is None:
+        asyncio.run(_run())
+    elif sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            runner.run(_run())
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.run(_run())
 
 
 if __name__ == "__main__":
@@ -1,4 +1,48 @@
-def remove_suffix(s: str, suffix: str) -> str:
-    if s.endswith(suffix):
-        return s[: -len(suffix)]
-    return s
+import hashlib
+from typing import List
+
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+def file_hash(path: str, algorithm: str = "md5") -> str:
+    with open(path, "rb", buffering=0) as fp:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(fp, algorithm).hexdigest()
+        h = hashlib.new(algorithm)
+        buf = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buf)
+        while True:
+            size = fp.readinto(buf)
+            if not size:
+                break
+            h.update(view[:size])
+        return h.hexdigest()
+
+
+def split_statements(sql: str, separator: str = ";") -> List[str]:
+    """Split a script on separators outside of quotes and comments."""
+    statements = []
+    start = i = 0
+    n = len(sql)
+    while i < n:
+        c = sql[i]
+        if c in "'\"`":
+            i += 1
+            while i < n and sql[i] != c:
+                i += 2 if sql[i] == "\\" else 1
+        elif sql.startswith("--", i):
+            i = sql.find("\n", i)
+            if i < 0:
+                i = n
+        elif sql.startswith("/*", i):
+            i = sql.find("*/", i + 2)
+            i = n if i < 0 else i + 1
+        elif sql.startswith(separator, i):
+            statements.append(sql[start:i])
+            start = i + len(separator)
+            i = start
+            continue
+        i += 1
+    statements.append(sql[start:])
+    return [s for s in (s.strip() for s in statements) if s]
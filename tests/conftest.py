@@ -1,5 +1,5 @@
+import asyncio
 import os
-import shutil
 import tempfile
 from dataclasses import dataclass
 from urllib.parse import urlparse
@@ -17,7 +17,14 @@ class ClickHouseConnectionInfo:
     PASSWORD: str = ""
 
 
-@pytest.fixture(scope="function")
+@pytest.fixture(scope="session")
+def event_loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
 async def clickhouse_conn_info():
     yield ClickHouseConnectionInfo(
         HOST=os.environ.get("TEST_CLICKHOUSE_HOST", "localhost"),
@@ -28,15 +35,15 @@ async def clickhouse_conn_info():
     )
 
 
-@pytest.fixture(scope="function")
+@pytest.fixture(scope="session")
 async def clickhouse_dsn():
     yield os.environ.get(
         "TEST_CLICKHOUSE_DSN", "clickhouse://localhost:9000/test_migrate"
     )
 
 
-@pytest.fixture(scope="function")
-async def database_exist(clickhouse_dsn):
+@pytest.fixture(scope="session")
+async def server_conn(clickhouse_dsn):
     r = urlparse(clickhouse_dsn)
     conn = await asynch.connect(
         host=r.hostname,
@@ -44,25 +51,45 @@ async def database_exist(clickhouse_dsn):
         user=r.username or "default",
         password=r.password or "",
     )
-    db_name = r.path.lstrip("/")
-    assert db_name.startswith("test_")  # test only testing database
-    async with conn.cursor() as cursor:
-        await cursor.execute(f"CREATE DATABASE IF NOT EXISTS {db_name}")
-    yield
-    async with conn.cursor() as cursor:
-        await cursor.execute(f"DROP DATABASE IF EXISTS {db_name}")
+    yield conn
     await conn.close()
 
 
+@pytest.fixture(scope="session")
+def database_name(clickhouse_dsn):
+    db_name = urlparse(clickhouse_dsn).path.lstrip("/")
+    assert db_name.startswith("test_")  # test only testing database
+    return db_name
+
+
 @pytest.fixture(scope="function")
-async def clickhouse_conn(clickhouse_dsn, database_exist):
+async def database_exist(database_name, server_conn):
+    cursor = server_conn.cursor()
+    await cursor.execute(f"CREATE DATABASE IF NOT EXISTS {database_name}")
+    yield
+    await cursor.execute(f"DROP DATABASE IF EXISTS {database_name}")
+
+
+@pytest.fixture(scope="session")
+async def session_conn(clickhouse_dsn, database_name, server_conn):
+    await server_conn.cursor().execute(f"CREATE DATABASE IF NOT EXISTS {database_name}")
     conn = await asynch.connect(dsn=clickhouse_dsn)
     yield conn
     await conn.close()
 
 
 @pytest.fixture(scope="function")
-def migration_path():
-    test_dir = tempfile.mkdtemp()
-    yield test_dir
-    shutil.rmtree(test_dir)
+async def clickhouse_conn(database_exist, session_conn):
+    yield session_conn
+
+
+@pytest.fixture(scope="session")
+def migrations_root():
+    shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    with tempfile.TemporaryDirectory(dir=shm) as root:
+        yield root
+
+
+@pytest.fixture(scope="function")
+def migration_path(migrations_root):
+    return tempfile.mkdtemp(dir=migrations_root)
@@ -1,10 +1,13 @@
+import asyncio
+import contextlib
+import hashlib
 import os.path
 import pathlib
+import tempfile
 from urllib.parse import urlparse
 
-import asynch
 import pytest
-from asynch.cursors import Cursor, DictCursor
+from asynch.cursors import Cursor
 
 from clickhouse_migrate.migrate import (
     ClickHouseMigrate,
@@ -12,6 +15,76 @@ from clickhouse_migrate.migrate import (
     Status,
     MigrationRecord,
 )
+from clickhouse_migrate.utils import split_statements
+
+
+TABLES = ("Table1", "Table2", "Table3", "Table4", "Table5")
+UP_SQL = tuple(
+    f"CREATE TABLE {table} (id UInt32) Engine=MergeTree ORDER BY (id)".encode()
+    for table in TABLES
+)
+DOWN_SQL = tuple(f"DROP TABLE {table};".encode() for table in TABLES)
+MIGRATION_NAME = "new_test_migration"
+UP_FILES = tuple(
+    f"{num:0>5d}_{MIGRATION_NAME}.up.sql" for num in range(1, len(TABLES) + 1)
+)
+DOWN_FILES = tuple(
+    f"{num:0>5d}_{MIGRATION_NAME}.down.sql" for num in range(1, len(TABLES) + 1)
+)
+EXISTING_TABLES_QUERY = (
+    "SELECT name FROM system.tables "
+    "WHERE database = currentDatabase() AND name IN %(names)s"
+)
+
+LAST_LOG_QUERY = """SELECT version, name, status, created_at, up_md5, down_md5
+    FROM `{table}` ORDER BY (created_at) DESC LIMIT 1"""
+
+
+async def _existing_tables(conn, names):
+    cursor = conn.cursor(cursor=Cursor)
+    await cursor.execute(EXISTING_TABLES_QUERY, {"names": tuple(names)})
+    return {row[0] for row in cursor.fetchall()}
+
+
+def _write_files(pairs):
+    for path, content in pairs:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, content)
+        finally:
+            os.close(fd)
+
+
+def _table_migrations(migration_path):
+    for up_file, up_sql, down_file, down_sql in zip(
+        UP_FILES, UP_SQL, DOWN_FILES, DOWN_SQL
+    ):
+        yield os.path.join(migration_path, up_file), up_sql
+        yield os.path.join(migration_path, down_file), down_sql
+
+
+@pytest.fixture(scope="module")
+def table_migrations_path(migrations_root):
+    path = tempfile.mkdtemp(dir=migrations_root)
+    _write_files(_table_migrations(path))
+    return path
+
+
+@pytest.fixture()
+async def migrate_factory(clickhouse_conn):
+    instances = []
+
+    def _fn(migrations_path):
+        m = ClickHouseMigrate(
+            clickhouse_conn=clickhouse_conn,
+            migrations_path=migrations_path,
+        )
+        instances.append(m)
+        return m
+
+    yield _fn
+    for m in instances:
+        await m.aclose()
 
 
 @pytest.mark.asyncio
@@ -68,100 +141,73 @@ async def test_connect_with_conn_info(clickhouse_conn_info, migration_path):
 
 
 @pytest.mark.asyncio
-async def test_show(clickhouse_conn, migration_path):
+async def test_connect_creates_database(
+    clickhouse_dsn, database_name, server_conn, migration_path
+):
+    name = f"{database_name}_missing"
+    cursor = server_conn.cursor(cursor=Cursor)
+    await cursor.execute(f"DROP DATABASE IF EXISTS {name}")
     m = ClickHouseMigrate(
-        clickhouse_conn=clickhouse_conn,
+        clickhouse_dsn=urlparse(clickhouse_dsn)._replace(path=f"/{name}").geturl(),
         migrations_path=migration_path,
     )
+    try:
+        assert await m._latest_version_and_status() is None
+        await cursor.execute(
+            "SELECT name FROM system.databases WHERE name = %(name)s", {"name": name}
+        )
+        assert cursor.fetchall() == [(name,)]
+    finally:
+        await m.aclose()
+        await cursor.execute(f"DROP DATABASE IF EXISTS {name}")
+
+
+@pytest.mark.asyncio
+async def test_show(migrate_factory, migration_path):
+    m = migrate_factory(migration_path)
     await m.show()
 
 
 @pytest.mark.asyncio
-async def test_migrate_make(clickhouse_conn, migration_path):
-    m = ClickHouseMigrate(
-        clickhouse_conn=clickhouse_conn,
-        migrations_path=migration_path,
-    )
-    assert isinstance(m, ClickHouseMigrate)
-    name = "new_test_migration"
-    await m.make(name)
-    num = 1
-    assert os.path.exists(os.path.join(migration_path, f"{num:0>5d}_{name}.up.sql"))
-    assert os.path.exists(os.path.join(migration_path, f"{num:0>5d}_{name}.down.sql"))
-    await m.make(name, force=True)
-    num += 1
-    assert os.path.exists(os.path.join(migration_path, f"{num:0>5d}_{name}.up.sql"))
-    assert os.path.exists(os.path.join(migration_path, f"{num:0>5d}_{name}.down.sql"))
+async def test_migrate_make(migrate_factory, migration_path):
+    m = migrate_factory(migration_path)
+    await m.make(MIGRATION_NAME)
+    await m.make(MIGRATION_NAME, force=True)
+    names = {entry.name for entry in os.scandir(migration_path)}
+    assert {*UP_FILES[:2], *DOWN_FILES[:2]} <= names
 
 
 @pytest.mark.asyncio
-async def test_migrate_up_down(clickhouse_conn, migration_path):
-    m = ClickHouseMigrate(
-        clickhouse_conn=clickhouse_conn,
-        migrations_path=migration_path,
-    )
-    assert isinstance(m, ClickHouseMigrate)
-    name = "new_test_migration"
-    for num in range(0, 5):
-        pathlib.Path(
-            os.path.join(migration_path, f"{num+1:0>5d}_{name}.up.sql")
-        ).write_text(
-            f"CREATE TABLE Table{num+1} (id UInt32) Engine=MergeTree ORDER BY (id);"
-        )
-        pathlib.Path(
-            os.path.join(migration_path, f"{num+1:0>5d}_{name}.down.sql")
-        ).write_text(f"DROP TABLE Table{num+1};")
+async def test_migrate_up_down(clickhouse_conn, migrate_factory, table_migrations_path):
+    m = migrate_factory(table_migrations_path)
     await m.up()
-    async with clickhouse_conn.cursor(cursor=Cursor) as cursor:
-        await cursor.execute(f"SHOW TABLES LIKE '{m.migrations_table}'")
-        res = cursor.fetchall()
-    assert len(res) > 0
-
-    for num in range(0, 5):
-        async with clickhouse_conn.cursor(cursor=Cursor) as cursor:
-            await cursor.execute(f"SHOW TABLES LIKE 'Table{num+1}'")
-            res = cursor.fetchall()
-        assert len(res) > 0
+    expected = {*TABLES, m.migrations_table}
+    assert await _existing_tables(clickhouse_conn, expected) == expected
     await m.down()
-    for num in range(0, 5):
-        async with clickhouse_conn.cursor(cursor=Cursor) as cursor:
-            await cursor.execute(f"SHOW TABLES LIKE 'Table{num+1}'")
-            res = cursor.fetchall()
-        assert len(res) == 0
+    assert await _existing_tables(clickhouse_conn, TABLES) == set()
 
 
-@pytest.fixture()
-def get_last_log(clickhouse_dsn):
+@pytest.fixture(scope="module")
+def get_last_log(session_conn):
+    cursor = session_conn.cursor(cursor=Cursor)
+
     async def _fn(m):
-        conn = await asynch.connect(dsn=clickhouse_dsn)
-        async with conn.cursor(cursor=DictCursor) as cursor:
-            await cursor.execute(
-                f"""SELECT version, name, status, up_md5, down_md5, created_at 
-                    FROM `{m.migrations_table}` ORDER BY (created_at) DESC LIMIT 1"""
-            )
-            res = cursor.fetchone()
-            return MigrationRecord(**res)
+        await cursor.execute(LAST_LOG_QUERY.format(table=m.migrations_table))
+        return MigrationRecord(*cursor.fetchone())
 
     return _fn
 
 
+@pytest.fixture()
+async def migrated(migrate_factory, table_migrations_path):
+    m = migrate_factory(table_migrations_path)
+    await m.up()
+    return m
+
+
 @pytest.mark.asyncio
-async def test_migrate_up_step(clickhouse_conn, migration_path, get_last_log):
-    m = ClickHouseMigrate(
-        clickhouse_conn=clickhouse_conn,
-        migrations_path=migration_path,
-    )
-    assert isinstance(m, ClickHouseMigrate)
-    name = "new_test_migration"
-    for num in range(0, 5):
-        pathlib.Path(
-            os.path.join(migration_path, f"{num+1:0>5d}_{name}.up.sql")
-        ).write_text(
-            f"CREATE TABLE Table{num+1} (id UInt32) Engine=MergeTree ORDER BY (id)"
-        )
-        pathlib.Path(
-            os.path.join(migration_path, f"{num+1:0>5d}_{name}.down.sql")
-        ).write_text(f"DROP TABLE Table{num+1};")
+async def test_migrate_up_step(migrate_factory, table_migrations_path, get_last_log):
+    m = migrate_factory(table_migrations_path)
     await m.up(step=1)
     mig1 = await get_last_log(m)
     assert mig1.version == 1
@@ -172,23 +218,8 @@ async def test_migrate_up_step(clickhouse_conn, migration_path, get_last_log):
 
 
 @pytest.mark.asyncio
-async def test_migrate_down_step(clickhouse_conn, migration_path, get_last_log):
-    m = ClickHouseMigrate(
-        clickhouse_conn=clickhouse_conn,
-        migrations_path=migration_path,
-    )
-    assert isinstance(m, ClickHouseMigrate)
-    name = "new_test_migration"
-    for num in range(0, 5):
-        pathlib.Path(
-            os.path.join(migration_path, f"{num+1:0>5d}_{name}.up.sql")
-        ).write_text(
-            f"CREATE TABLE Table{num+1} (id UInt32) Engine=MergeTree ORDER BY (id)"
-        )
-        pathlib.Path(
-            os.path.join(migration_path, f"{num+1:0>5d}_{name}.down.sql")
-        ).write_text(f"DROP TABLE Table{num+1};")
-    await m.up()
+async def test_migrate_down_step(migrated, get_last_log):
+    m = migrated
     mig0 = await get_last_log(m)
     assert mig0.version == 5
 
@@ -204,23 +235,8 @@ async def test_migrate_down_step(clickhouse_conn, migration_path, get_last_log):
 
 
 @pytest.mark.asyncio
-async def test_migrate_force(clickhouse_conn, migration_path, get_last_log):
-    m = ClickHouseMigrate(
-        clickhouse_conn=clickhouse_conn,
-        migrations_path=migration_path,
-    )
-    assert isinstance(m, ClickHouseMigrate)
-    name = "new_test_migration"
-    for num in range(0, 5):
-        pathlib.Path(
-            os.path.join(migration_path, f"{num+1:0>5d}_{name}.up.sql")
-        ).write_text(
-            f"CREATE TABLE Table{num+1} (id UInt32) Engine=MergeTree ORDER BY (id)"
-        )
-        pathlib.Path(
-            os.path.join(migration_path, f"{num+1:0>5d}_{name}.down.sql")
-        ).write_text(f"DROP TABLE Table{num+1};")
-    await m.up()
+async def test_migrate_force(migrated, get_last_log):
+    m = migrated
     mig1 = await get_last_log(m)
 
     await m._log_action(
@@ -241,38 +257,27 @@ async def test_migrate_force(clickhouse_conn, migration_path, get_last_log):
 
 
 @pytest.mark.asyncio
-async def test_migrate_reset(clickhouse_conn, migration_path, get_last_log):
-    m = ClickHouseMigrate(
-        clickhouse_conn=clickhouse_conn,
-        migrations_path=migration_path,
-    )
-    assert isinstance(m, ClickHouseMigrate)
-    name = "new_test_migration"
-    for num in range(0, 5):
-        pathlib.Path(
-            os.path.join(migration_path, f"{num+1:0>5d}_{name}.up.sql")
-        ).write_text(
-            f"CREATE TABLE Table{num+1} (id UInt32) Engine=MergeTree ORDER BY (id)"
-        )
-        pathlib.Path(
-            os.path.join(migration_path, f"{num+1:0>5d}_{name}.down.sql")
-        ).write_text(f"DROP TABLE Table{num+1};")
-    await m.up()
+async def test_migrate_reset(migrated, get_last_log):
+    m = migrated
     mig1 = await get_last_log(m)
 
-    await m._log_action(
-        version=mig1.version - 1,
-        name=mig1.name,
-        status=Status.UP,
-        up_md5=mig1.up_md5,
-        down_md5=mig1.down_md5,
-    )
-    await m._log_action(
-        version=mig1.version,
-        name=mig1.name,
-        status=Status.DIRTY_UP,
-        up_md5=mig1.up_md5,
-        down_md5=mig1.down_md5,
+    await m._log_actions_bulk(
+        [
+            m._log_row(
+                version=mig1.version - 1,
+                name=mig1.name,
+                status=Status.UP,
+                up_md5=mig1.up_md5,
+                down_md5=mig1.down_md5,
+            ),
+            m._log_row(
+                version=mig1.version,
+                name=mig1.name,
+                status=Status.DIRTY_UP,
+                up_md5=mig1.up_md5,
+                down_md5=mig1.down_md5,
+            ),
+        ]
     )
     mig2 = await get_last_log(m)
     assert mig2.version == mig1.version
@@ -284,47 +289,165 @@ async def test_migrate_reset(clickhouse_conn, migration_path, get_last_log):
     assert mig3.status == Status.UP
 
 
-ddl_replcated = """
-        CREATE TABLE Table1 
-        {% if CLUSTER_NAME %} 
-            ON CLUSTER {{CLUSTER_NAME}}
-        {% endif %}
-            (x UInt32)
-        {% if CLUSTER_NAME %} 
-            ReplicatedMergeTree('/clickhouse/tables/{shard}/{database}/table_name', '{replica}')
-        {% else %}
-            ENGINE = MergeTree
-        {% endif %}
-        ORDER BY x;
+@pytest.mark.asyncio
+async def test_migrate_up_parallel_reset(migrate_factory, migration_path, get_last_log):
+    up_sql = (UP_SQL[0], b"CREATE TABLE Broken (", UP_SQL[2])
+    _write_files(
+        (os.path.join(migration_path, filename), sql)
+        for filename, sql in zip(UP_FILES + DOWN_FILES, up_sql + DOWN_SQL[:3])
+    )
+    m = migrate_factory(migration_path)
+    await m.up(parallel=3)
+    mig1 = await get_last_log(m)
+    assert mig1.version == 2
+    assert mig1.status == Status.DIRTY_UP
+
+    await m.force(reset=True)
+    mig2 = await get_last_log(m)
+    assert mig2.version == 1
+    assert mig2.status == Status.UP
+
+
+@pytest.mark.asyncio
+async def test_migrate_up_only(migrate_factory, migration_path, get_last_log):
+    _write_files([(os.path.join(migration_path, UP_FILES[0]), UP_SQL[0])])
+    m = migrate_factory(migration_path)
+    await m.up()
+    mig = await get_last_log(m)
+    assert mig.version == 1
+    assert mig.status == Status.UP
+    assert mig.down_md5 == ""
+
+
+def test_log_row_without_down_file(clickhouse_dsn, migration_path):
+    _write_files([(os.path.join(migration_path, UP_FILES[0]), UP_SQL[0])])
+    m = ClickHouseMigrate(
+        clickhouse_dsn=clickhouse_dsn,
+        migrations_path=migration_path,
+    )
+    (meta,) = m.file_migrations()
+    row = m._meta_log_row(meta, Status.UP)
+    assert row[3] == meta.up_md5
+    assert row[4] == ""
+
+
+def test_split_statements():
+    script = """
+        CREATE TABLE Table1 (x String DEFAULT ';') ENGINE = Memory;
+        -- comment; with separator
+        INSERT INTO Table1 VALUES ('it\\'s; quoted');
+        /* block; comment */ DROP TABLE Table1;;
         """
+    assert split_statements(script) == [
+        "CREATE TABLE Table1 (x String DEFAULT ';') ENGINE = Memory",
+        "-- comment; with separator\n        INSERT INTO Table1 VALUES ('it\\'s; quoted')",
+        "/* block; comment */ DROP TABLE Table1",
+    ]
+    assert split_statements("SELECT 1") == ["SELECT 1"]
+    assert split_statements(" ; ") == []
 
 
-def test_usage_cluster(clickhouse_conn, migration_path):
-    environ = {
-        "CLUSTER_NAME": "my_cluster",
-    }
+def test_broken_file_sequence(clickhouse_dsn, migration_path):
     m = ClickHouseMigrate(
-        clickhouse_conn=clickhouse_conn,
+        clickhouse_dsn=clickhouse_dsn,
         migrations_path=migration_path,
-        environ=environ,
     )
-    filename = "test_env.up.sql"
-    with open(os.path.join(migration_path, filename), "wt") as f:
-        f.write(ddl_replcated)
-    result = m._render(filename)
-    assert environ["CLUSTER_NAME"] in result
-    assert "ON CLUSTER" in result
-    assert "ReplicatedMergeTree" in result
+    for version in (1, 2, 5):
+        pathlib.Path(migration_path, f"{version:0>5d}_test.up.sql").write_text("")
+    with pytest.raises(MigrationError, match="Versions: 3, 4 - broken file sequence"):
+        m.file_migrations()
+
+
+@pytest.mark.parametrize(
+    "filenames, error",
+    [
+        (("00000_zero.up.sql", "00001_one.up.sql"), "Versions: 0 - unexpected"),
+        (("00001_one.up.sql", "001_other.up.sql"), "Version: 1 - duplicate"),
+    ],
+)
+def test_unexpected_file_versions(clickhouse_dsn, migration_path, filenames, error):
+    m = ClickHouseMigrate(
+        clickhouse_dsn=clickhouse_dsn,
+        migrations_path=migration_path,
+    )
+    for filename in filenames:
+        pathlib.Path(migration_path, filename).write_text("")
+    with pytest.raises(MigrationError, match=error):
+        m.file_migrations()
 
 
-def test_usage_wo_cluster(clickhouse_conn, migration_path):
+def test_file_digests_reused(clickhouse_dsn, migration_path):
+    _write_files(_table_migrations(migration_path))
     m = ClickHouseMigrate(
-        clickhouse_conn=clickhouse_conn,
+        clickhouse_dsn=clickhouse_dsn,
+        migrations_path=migration_path,
+    )
+    files = m.file_migrations()
+    digests = [(f.up_md5, f.down_md5) for f in files]
+
+    edited = os.path.join(migration_path, UP_FILES[1])
+    _write_files([(edited, UP_SQL[1] + b";")])
+    st = os.stat(edited)
+    os.utime(edited, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    rescanned = m.file_migrations()
+    assert rescanned is not files
+    assert rescanned[0]._up_md5 == digests[0][0]
+    assert rescanned[1]._up_md5 is None
+    assert rescanned[1]._down_md5 == digests[1][1]
+    assert rescanned[1].up_md5 == hashlib.md5(UP_SQL[1] + b";").hexdigest()
+    assert m.file_migrations() is rescanned
+
+
+def test_hash_algorithm(clickhouse_dsn, migration_path):
+    _write_files(_table_migrations(migration_path))
+    m = ClickHouseMigrate(
+        clickhouse_dsn=clickhouse_dsn,
         migrations_path=migration_path,
+        hash_algorithm="sha256",
     )
-    filename = "test_env.up.sql"
-    with open(os.path.join(migration_path, filename), "wt") as f:
-        f.write(ddl_replcated)
-    result = m._render(filename)
-    assert "ON CLUSTER" not in result
-    assert "ReplicatedMergeTree" not in result
+    meta = m.file_migrations()[0]
+    assert meta.up_md5 == hashlib.sha256(UP_SQL[0]).hexdigest()
+    assert meta.down_md5 == hashlib.sha256(DOWN_SQL[0]).hexdigest()
+    for name in ("not_a_digest", "shake_128"):
+        with pytest.raises(ValueError):
+            ClickHouseMigrate(
+                clickhouse_dsn=clickhouse_dsn,
+                migrations_path=migration_path,
+                hash_algorithm=name,
+            )
+
+
+@pytest.mark.asyncio
+async def test_pool_replaces_broken_connections(
+    clickhouse_dsn, migration_path, monkeypatch
+):
+    m = ClickHouseMigrate(
+        clickhouse_dsn=clickhouse_dsn,
+        migrations_path=migration_path,
+        pool_size=1,
+    )
+    opened = []
+
+    class _Conn:
+        closed = False
+
+        async def close(self):
+            self.closed = True
+
+    async def _connect():
+        opened.append(_Conn())
+        return opened[-1]
+
+    monkeypatch.setattr(m, "_connect", _connect)
+
+    async def _use(broken):
+        with contextlib.suppress(ConnectionError):
+            async with m._connection():
+                await asyncio.sleep(0)
+                if broken:
+                    raise ConnectionError
+
+    await asyncio.wait_for(asyncio.gather(_use(True), _use(True), _use(False)), 1)
+    assert [conn.closed for conn in opened] == [True, True, False]
+    await m.aclose()
+    assert opened[-1].closed
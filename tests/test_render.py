@@ -0,0 +1,108 @@
+import os
+import pathlib
+from collections.abc import Mapping
+import tempfile
+
+import jinja2
+import pytest
+
+from clickhouse_migrate.migrate import ClickHouseMigrate
+
+
+ddl_replcated = """
+        CREATE TABLE Table1 
+        {% if CLUSTER_NAME %} 
+            ON CLUSTER {{CLUSTER_NAME}}
+        {% endif %}
+            (x UInt32)
+        {% if CLUSTER_NAME %} 
+            ReplicatedMergeTree('/clickhouse/tables/{shard}/{database}/table_name', '{replica}')
+        {% else %}
+            ENGINE = MergeTree
+        {% endif %}
+        ORDER BY x;
+        """
+_COMPILED_DDL = jinja2.Environment(autoescape=False).from_string(ddl_replcated)
+CLUSTER_ENVIRON = {
+    "CLUSTER_NAME": "my_cluster",
+}
+
+
+@pytest.fixture(scope="module")
+def render_path(migrations_root):
+    return tempfile.mkdtemp(dir=migrations_root)
+
+
+@pytest.fixture(scope="module")
+def renderer(clickhouse_dsn, render_path):
+    def _fn(environ=None):
+        return ClickHouseMigrate(
+            clickhouse_dsn=clickhouse_dsn,
+            migrations_path=render_path,
+            environ=environ,
+        )
+
+    return _fn
+
+
+@pytest.fixture(scope="module")
+def ddl_file(render_path):
+    path = pathlib.Path(render_path, "test_env.up.sql")
+    path.write_text(ddl_replcated)
+    return path.name
+
+
+def test_render_matches_compiled(renderer, ddl_file):
+    for environ in (CLUSTER_ENVIRON, None):
+        m = renderer(environ)
+        assert m._render(ddl_file) == _COMPILED_DDL.render(**(environ or {}))
+
+
+def test_usage_cluster(renderer, ddl_file):
+    result = renderer(CLUSTER_ENVIRON)._render(ddl_file)
+    assert CLUSTER_ENVIRON["CLUSTER_NAME"] in result
+    assert "ON CLUSTER" in result
+    assert "ReplicatedMergeTree" in result
+
+
+def test_usage_wo_cluster(renderer, ddl_file):
+    result = renderer()._render(ddl_file)
+    assert "ON CLUSTER" not in result
+    assert "ReplicatedMergeTree" not in result
+
+
+def test_environ_read_once(renderer, ddl_file):
+    environ = {**CLUSTER_ENVIRON}
+    m = renderer(environ)
+    rendered = m._render(ddl_file)
+    environ.clear()
+    assert m._render(ddl_file) == rendered
+    assert "ON CLUSTER" in rendered
+
+
+def test_render_picks_up_edited_file(renderer, render_path):
+    path = pathlib.Path(render_path, "test_edit.up.sql")
+    path.write_text("SELECT {{ VALUE }}")
+    assert renderer({"VALUE": 1})._render(path.name) == "SELECT 1"
+    path.write_text("SELECT {{ VALUE }} + 1")
+    # bump the mtime, the rewrite may land within the filesystem resolution
+    st = path.stat()
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert renderer({"VALUE": 1})._render(path.name) == "SELECT 1 + 1"
+
+
+class _UnreadableEnviron(Mapping):
+    def __getitem__(self, key):
+        raise AssertionError("environ read")
+
+    def __iter__(self):
+        raise AssertionError("environ read")
+
+    def __len__(self):
+        raise AssertionError("environ read")
+
+
+def test_constant_sql_skips_environ(renderer, render_path):
+    path = pathlib.Path(render_path, "test_const.up.sql")
+    path.write_text("SELECT 1")
+    assert renderer(_UnreadableEnviron())._render(path.name) == "SELECT 1"
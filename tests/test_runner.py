@@ -0,0 +1,90 @@
+import os
+import pathlib
+
+import pytest
+
+from clickhouse_migrate import runner
+
+
+@pytest.fixture()
+def environ(monkeypatch):
+    values = {}
+    monkeypatch.setattr(runner, "ENV_PREFIX", "")
+    monkeypatch.setattr(runner, "_ENV_SNAPSHOT", values)
+    return values
+
+
+def _parse(argv):
+    return runner._build_parser(argv).parse_args(argv)
+
+
+@pytest.mark.parametrize(
+    "argv, command",
+    [
+        (["up"], "up"),
+        (["--host", "h", "up"], "up"),
+        (["--env=x", "show"], "show"),
+        (["--verbose", "up"], "up"),
+        (["--verb", "up"], None),
+        (["--host"], None),
+        ([], None),
+    ],
+)
+def test_subcommand(argv, command):
+    assert runner._subcommand(argv) == command
+
+
+def test_parse_options_before_command(environ):
+    args = _parse(["--host", "h", "--env=x", "up", "2", "--parallel", "3"])
+    assert args.subparser_name == "up"
+    assert (args.host, args.env, args.step, args.parallel) == ("h", "x", 2, 3)
+    assert _parse(["--verbose", "down"]).verbose
+
+
+def test_parse_falls_back_to_every_command(environ):
+    args = _parse(["--verb", "show_sql", "1", "down"])
+    assert args.verbose
+    assert (args.subparser_name, args.step, args.direction) == ("show_sql", 1, "down")
+    assert _parse([]).subparser_name is None
+
+
+def test_env_defaults(environ):
+    args = _parse([])
+    assert (args.username, args.port, args.secure) == ("default", 9000, False)
+
+    environ.update({"CLICKHOUSE_USER": "user", "CLICKHOUSE_PORT": "9440"})
+    environ["CLICKHOUSE_SECURE"] = "true"
+    args = _parse([])
+    assert (args.username, args.port, args.secure) == ("user", 9440, True)
+
+    environ["CLICKHOUSE_USERNAME"] = "username"
+    assert _parse([]).username == "username"
+
+
+def test_env_prefix(environ, monkeypatch):
+    monkeypatch.setattr(runner, "ENV_PREFIX", "APP_")
+    environ.update({"CLICKHOUSE_HOST": "plain", "APP_CLICKHOUSE_HOST": "prefixed"})
+    assert _parse([]).host == "prefixed"
+
+
+def test_load_dotenv_missing(tmp_path):
+    assert runner._load_dotenv(str(tmp_path / "missing.env")) == {}
+    assert runner._load_dotenv(str(tmp_path)) == {}
+
+
+def test_load_dotenv_reloads_edited_file(tmp_path):
+    path = pathlib.Path(tmp_path, ".env")
+    path.write_text("CLICKHOUSE_HOST=first\n")
+    assert runner._load_dotenv(str(path)) == {"CLICKHOUSE_HOST": "first"}
+    assert runner._load_dotenv(str(path)) == {"CLICKHOUSE_HOST": "first"}
+
+    path.write_text("CLICKHOUSE_HOST=second\n")
+    st = path.stat()
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert runner._load_dotenv(str(path)) == {"CLICKHOUSE_HOST": "second"}
+
+
+def test_load_environment_from_directory(tmp_path, environ, monkeypatch):
+    monkeypatch.setattr(runner.sys, "argv", ["chmigrate", "--env", str(tmp_path)])
+    runner._load_environment_from_file()
+    assert runner._ENV_SNAPSHOT == dict(os.environ)